@@ -16,7 +16,39 @@ import os
 
 import redis
 from celery.app import Celery
+from celery.signals import worker_process_init
 
 REDIS_URL = os.getenv("REDIS_URL")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONN", "32"))
+# Seconds before the broker redelivers an unacknowledged task to another worker.
+# Tasks are acked late, so this should be longer than the longest expected import.
+# It is also how long a task interrupted by a killed worker waits to be rerun.
+TASK_VISIBILITY_TIMEOUT = int(os.getenv("CELERY_VISIBILITY_TIMEOUT", "10800"))
+
 celery = Celery(broker=REDIS_URL, backend=REDIS_URL, include=["src.tasks"])
-redis_client = redis.Redis.from_url(REDIS_URL)
+# Imports are long running, so only reserve one task at a time per child process
+# and acknowledge it once it has finished.
+celery.conf.update(
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+    broker_transport_options={"visibility_timeout": TASK_VISIBILITY_TIMEOUT},
+)
+
+# Shared connection pool so concurrent tasks don't serialize on a single socket.
+_pool = redis.ConnectionPool.from_url(
+    REDIS_URL,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    socket_keepalive=True,
+    socket_timeout=5,
+    health_check_interval=30,
+)
+redis_client = redis.Redis(connection_pool=_pool)
+
+
+@worker_process_init.connect
+def _reset_redis_pool(**kwargs):
+    """Drop connections inherited from the parent process after a fork.
+
+    The pool reconnects lazily, so each child ends up with its own sockets.
+    """
+    _pool.disconnect()
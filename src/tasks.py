@@ -12,14 +12,252 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
+from celery.utils.log import get_task_logger
 from openrelik_worker_common.task_utils import create_task_result, get_input_files
-from timesketch_api_client import client as timesketch_client
-from timesketch_import_client import importer
 
 from .app import celery, redis_client
 
+logger = get_task_logger(__name__)
+
+# Connection details from environment variables, resolved once at worker startup
+# so that a broken configuration fails fast.
+try:
+    TIMESKETCH_SERVER_URL = os.environ["TIMESKETCH_SERVER_URL"]
+    TIMESKETCH_SERVER_PUBLIC_URL = os.environ["TIMESKETCH_SERVER_PUBLIC_URL"]
+    TIMESKETCH_USERNAME = os.environ["TIMESKETCH_USERNAME"]
+    TIMESKETCH_PASSWORD = os.environ["TIMESKETCH_PASSWORD"]
+except KeyError as e:
+    raise ValueError(f"Missing required environment variable: {e.args[0]}") from e
+
+# Time to live (in seconds) for the cached workflow sketch ID in Redis.
+SKETCH_CACHE_TTL = 86400
+
+# Time to live (in seconds) for the cached result of a completed upload.
+UPLOAD_RESULT_TTL = 86400
+
+# Prefix of the marker claiming an upload that is still in progress.
+UPLOAD_IN_PROGRESS_PREFIX = "in-progress:"
+
+# Expiry (in seconds) of the in-progress marker, and how often a running upload
+# refreshes it. A live upload stays claimed however long it runs, while the claim
+# of a worker that died expires quickly.
+UPLOAD_CLAIM_TTL = 180
+UPLOAD_CLAIM_REFRESH_INTERVAL = 60
+
+# How long (in seconds) a redelivered copy of the task waits before checking the
+# claim again, and how many times it does so before giving up.
+UPLOAD_IN_PROGRESS_RETRY_DELAY = 60
+UPLOAD_IN_PROGRESS_MAX_RETRIES = 60
+
+# Expiry (in seconds) of the key guarding creation of a workflow sketch.
+SKETCH_LOCK_TIMEOUT = 60
+
+# How long (in seconds) to wait for another worker to create the workflow sketch.
+SKETCH_WAIT_TIMEOUT = 5
+
+# File types (extensions) the Timesketch importer accepts.
+SUPPORTED_FILE_TYPES = ("csv", "jsonl", "plaso")
+
+# Maximum number of files imported to Timesketch concurrently.
+IMPORT_CONCURRENCY = max(1, int(os.getenv("TS_IMPORT_CONCURRENCY", "4")))
+
+# Maximum age (in seconds) of the shared Timesketch API client before it logs in
+# again, so that expired server sessions and CSRF tokens are refreshed.
+TIMESKETCH_CLIENT_MAX_AGE = 600
+
+# HTTP status codes from Timesketch that invalidate the shared API client.
+TIMESKETCH_AUTH_ERROR_STATUS_CODES = (400, 401, 403)
+
+# Authenticated Timesketch API client, shared by all tasks in this process.
+_ts_client = None
+_ts_client_created = 0.0
+_ts_lock = threading.Lock()
+
+
+# Deletes a key only if it still holds the given value, so a worker never releases
+# a key that has expired and been claimed by another worker.
+_DELETE_IF_VALUE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+# Sets the expiry of a key only if it still holds the given value.
+_EXPIRE_IF_VALUE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def _delete_if_value(redis_client, key, value):
+    """Deletes a Redis key if it still holds the given value."""
+    return redis_client.eval(_DELETE_IF_VALUE_SCRIPT, 1, key, value)
+
+
+def _expire_if_value(redis_client, key, value, seconds):
+    """Sets the expiry of a Redis key if it still holds the given value."""
+    return redis_client.eval(_EXPIRE_IF_VALUE_SCRIPT, 1, key, value, seconds)
+
+
+def _keep_claim_alive(redis_client, key, token, stop_event):
+    """Refreshes the expiry of an upload claim until stop_event is set.
+
+    Args:
+        redis_client: Redis client.
+        key: Redis key holding the claim.
+        token: Value of the claim, so that only our own claim is refreshed.
+        stop_event: threading.Event that is set when the upload has finished.
+    """
+    while not stop_event.wait(UPLOAD_CLAIM_REFRESH_INTERVAL):
+        try:
+            _expire_if_value(redis_client, key, token, UPLOAD_CLAIM_TTL)
+        except Exception:
+            logger.warning("Failed to refresh upload claim %s", key, exc_info=True)
+
+
+def _file_type(file_path):
+    """Returns the file type of a path the way the Timesketch importer sees it."""
+    return file_path.lower().split(".")[-1]
+
+
+def _sketch_cache_key(workflow_id):
+    """Returns the Redis key used to cache the sketch ID for a workflow."""
+    return f"openrelik:sketch:{workflow_id}"
+
+
+def _upload_result_key(workflow_id, input_files, task_config):
+    """Returns the Redis key claiming an upload and caching its result.
+
+    The key identifies the workflow, the set of input files and the task config, so
+    a redelivered task maps to the same key as the original one.
+    """
+    input_paths = "|".join(sorted(f.get("path") for f in input_files))
+    config = json.dumps(task_config, sort_keys=True)
+    digest = hashlib.sha1(f"{input_paths}|{config}".encode()).hexdigest()
+    return f"openrelik:upload:{workflow_id}:{digest}"
+
+
+def _sketch_lock_key(workflow_id):
+    """Returns the Redis key guarding creation of the sketch for a workflow."""
+    return f"openrelik:sketch:lock:{workflow_id}"
+
+
+def _get_cached_workflow_sketch(timesketch_api_client, redis_client, cache_key):
+    """Returns the sketch cached for a workflow, if it still exists.
+
+    The sketch is loaded from the server to make sure it has not been deleted since
+    it was cached. A stale cache entry is removed.
+
+    Args:
+        timesketch_api_client: Timesketch API client.
+        redis_client: Redis client.
+        cache_key: Redis key holding the cached sketch ID.
+
+    Returns:
+        Timesketch sketch object or None if not cached or no longer available.
+    """
+    cached_sketch_id = redis_client.get(cache_key)
+    if not cached_sketch_id:
+        return None
+
+    sketch = timesketch_api_client.get_sketch(int(cached_sketch_id))
+    try:
+        sketch.lazyload_data()
+    except RuntimeError:
+        logger.warning("Cached sketch %s is no longer available", cached_sketch_id)
+        redis_client.delete(cache_key)
+        return None
+    return sketch
+
+
+def _find_sketch_by_name(timesketch_api_client, sketch_name):
+    """Searches the sketches available to the user for one with a given name.
+
+    Sketches are fetched page by page, so stopping at the first match skips the
+    remaining pages.
+
+    Args:
+        timesketch_api_client: Timesketch API client.
+        sketch_name: Name of the sketch to find.
+
+    Returns:
+        Timesketch sketch object or None if not found.
+    """
+    for _sketch in timesketch_api_client.list_sketches():
+        if _sketch.name == sketch_name:
+            return _sketch
+    return None
+
+
+def _invalidate_ts_client(ts_client):
+    """Drops the shared Timesketch API client so the next task logs in again.
+
+    Args:
+        ts_client: The client to drop. Ignored if it has already been replaced.
+    """
+    global _ts_client
+    with _ts_lock:
+        if _ts_client is ts_client:
+            _ts_client = None
+
+
+def _get_ts_client():
+    """Returns a cached Timesketch API client, creating it on first use.
+
+    Reusing the client avoids a new login for every task and lets the underlying
+    HTTP session keep connections alive between requests. The client is rebuilt
+    once it is older than TIMESKETCH_CLIENT_MAX_AGE, or after Timesketch rejected
+    one of its requests with an authentication or CSRF error.
+
+    Returns:
+        Timesketch API client.
+    """
+    global _ts_client, _ts_client_created
+    with _ts_lock:
+        if (
+            _ts_client is None
+            or time.monotonic() - _ts_client_created > TIMESKETCH_CLIENT_MAX_AGE
+        ):
+            # Imported lazily to keep worker startup fast.
+            from requests.adapters import HTTPAdapter
+            from timesketch_api_client import client as timesketch_client
+            from urllib3.util.retry import Retry
+
+            ts_client = timesketch_client.TimesketchApi(
+                host_uri=TIMESKETCH_SERVER_URL,
+                username=TIMESKETCH_USERNAME,
+                password=TIMESKETCH_PASSWORD,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=64,
+                max_retries=Retry(total=3, backoff_factor=0.5),
+            )
+            ts_client.session.mount("http://", adapter)
+            ts_client.session.mount("https://", adapter)
+
+            def _invalidate_on_auth_error(response, *args, **kwargs):
+                if response.status_code in TIMESKETCH_AUTH_ERROR_STATUS_CODES:
+                    _invalidate_ts_client(ts_client)
+
+            ts_client.session.hooks["response"].append(_invalidate_on_auth_error)
+            _ts_client = ts_client
+            _ts_client_created = time.monotonic()
+        return _ts_client
+
 
 def get_or_create_sketch(
     timesketch_api_client,
@@ -30,7 +268,7 @@ def get_or_create_sketch(
 ):
     """
     Retrieves or creates a sketch, handling locking if needed.
-    This uses Redis distrubuted lock to avoid race conditions.
+    This uses an atomic Redis SET NX key to avoid race conditions.
 
     Args:
         client: Timesketch API client.
@@ -41,33 +279,163 @@ def get_or_create_sketch(
 
     Returns:
         Timesketch sketch object or None if failed
-    """
-    sketch = None
 
+    Raises:
+        RuntimeError: If the Timesketch API client fails to create the sketch.
+        TimeoutError: If another worker did not create the workflow sketch in time.
+    """
     if sketch_id:
-        sketch = timesketch_api_client.get_sketch(int(sketch_id))
-    elif sketch_name:
-        sketch = timesketch_api_client.create_sketch(sketch_name)
-    else:
-        sketch_name = f"openrelik-workflow-{workflow_id}"
-        # Prevent multiple distributed workers from concurrently creating the same
-        # sketch. This Redis-based lock ensures only one worker proceeds at a time, even
-        # across different machines. The code will block until the lock is acquired.
-        # The lock automatically expires after 60 seconds to prevent deadlocks.
-        with redis_client.lock(sketch_name, timeout=60, blocking_timeout=5):
+        return timesketch_api_client.get_sketch(int(sketch_id))
+
+    if sketch_name:
+        return timesketch_api_client.create_sketch(sketch_name)
+
+    sketch_name = f"openrelik-workflow-{workflow_id}"
+    cache_key = _sketch_cache_key(workflow_id)
+
+    # Fast path: the sketch for this workflow has already been resolved.
+    sketch = _get_cached_workflow_sketch(timesketch_api_client, redis_client, cache_key)
+    if sketch:
+        return sketch
+
+    # Prevent multiple distributed workers from concurrently creating the same
+    # sketch. Only the worker that wins the atomic SET NX on the lock key looks
+    # up or creates the sketch, even across different machines. Other workers
+    # wait for the winner to publish the sketch ID in the cache.
+    # The lock key automatically expires after 60 seconds to prevent deadlocks.
+    lock_key = _sketch_lock_key(workflow_id)
+    lock_token = uuid.uuid4().hex
+    if redis_client.set(lock_key, lock_token, nx=True, ex=SKETCH_LOCK_TIMEOUT):
+        try:
+            # Another worker might have resolved the sketch just before us.
+            sketch = _get_cached_workflow_sketch(
+                timesketch_api_client, redis_client, cache_key
+            )
+            if sketch:
+                return sketch
+
             # Search for an existing sketch while having the lock
-            for _sketch in timesketch_api_client.list_sketches():
-                if _sketch.name == sketch_name:
-                    sketch = _sketch
-                    break
+            sketch = _find_sketch_by_name(timesketch_api_client, sketch_name)
 
             # If not found, create a new one
             if not sketch:
                 sketch = timesketch_api_client.create_sketch(sketch_name)
 
+            if sketch:
+                redis_client.set(cache_key, sketch.id, ex=SKETCH_CACHE_TTL)
+        finally:
+            # Let another worker retry if we failed to resolve the sketch.
+            if not sketch:
+                _delete_if_value(redis_client, lock_key, lock_token)
+    else:
+        deadline = time.monotonic() + SKETCH_WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            sketch = _get_cached_workflow_sketch(
+                timesketch_api_client, redis_client, cache_key
+            )
+            if sketch:
+                return sketch
+            time.sleep(0.1)
+        raise TimeoutError(
+            f"Timed out waiting for another worker to create sketch '{sketch_name}'"
+        )
+
     return sketch
 
 
+def _import_to_timesketch(input_files, workflow_id, task_config):
+    """Imports the input files to a Timesketch sketch.
+
+    Args:
+        input_files: List of input file dictionaries to import.
+        workflow_id: ID of the workflow.
+        task_config: User configuration for the task.
+
+    Returns:
+        Base64-encoded dictionary containing task results.
+    """
+    # Imported lazily to keep worker startup fast.
+    from timesketch_import_client import importer
+
+    # User supplied config.
+    sketch_id = task_config.get("sketch_id")
+    sketch_name = task_config.get("sketch_name")
+    timeline_name = task_config.get("timeline_name")
+
+    # Get the (cached) Timesketch API client.
+    timesketch_api_client = _get_ts_client()
+
+    # Get or create sketch using a distributed lock.
+    sketch = get_or_create_sketch(
+        timesketch_api_client,
+        redis_client,
+        sketch_id=sketch_id,
+        sketch_name=sketch_name,
+        workflow_id=workflow_id,
+    )
+
+    if not sketch:
+        raise Exception(f"Failed to create or retrieve sketch '{sketch_name}'")
+
+    # Resolve the sketch URL before importing so the result doesn't depend on
+    # sketch attribute access after the (long running) imports.
+    sketch_url = f"{TIMESKETCH_SERVER_PUBLIC_URL}/sketch/{sketch.id}"
+
+    # Make the sketch public.
+    # TODO: Make this user configurable.
+    sketch.add_to_acl(group_list=["all"])
+
+    # Without a configured timeline name every file gets its own timeline. With one,
+    # files of the same type are imported through a single streamer into one
+    # timeline, so the streamer can batch its uploads across files. Each file type
+    # gets its own timeline because the streamer takes its data label from the first
+    # file it imports.
+    if timeline_name:
+        files_by_type = defaultdict(list)
+        for input_file in input_files:
+            file_path = input_file.get("path")
+            files_by_type[_file_type(file_path)].append(file_path)
+        timeline_groups = [
+            (timeline_name, file_paths) for file_paths in files_by_type.values()
+        ]
+    else:
+        timeline_groups = [
+            (input_file.get("display_name"), [input_file.get("path")])
+            for input_file in input_files
+        ]
+
+    def _import_timeline(group_name, file_paths):
+        with importer.ImportStreamer() as streamer:
+            streamer.set_sketch(sketch)
+            streamer.set_timeline_name(group_name)
+            for file_path in file_paths:
+                streamer.add_file(file_path)
+
+    # Import each timeline to it's own index. The imports are independent and I/O
+    # bound so run a bounded number of them concurrently.
+    max_workers = min(len(timeline_groups), IMPORT_CONCURRENCY)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [
+            executor.submit(_import_timeline, group_name, file_paths)
+            for group_name, file_paths in timeline_groups
+        ]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in done:
+            # Re-raise any exception from the import.
+            future.result()
+    finally:
+        # Don't start queued imports once one of them has failed.
+        executor.shutdown(cancel_futures=True)
+
+    return create_task_result(
+        output_files=[],
+        workflow_id=workflow_id,
+        command="Timesketch Importer Client",
+        meta={"sketch": sketch_url},
+    )
+
+
 # Task name used to register and route the task to the correct queue.
 TASK_NAME = "openrelik-worker-timesketch.tasks.upload"
 
@@ -90,6 +458,16 @@ TASK_METADATA = {
             "type": "text",
             "required": False,
         },
+        {
+            "name": "timeline_name",
+            "label": "Import files into one timeline per file type",
+            "description": (
+                "Name of the timeline to import files into. Files of the same type "
+                "(csv, jsonl or plaso) share one timeline."
+            ),
+            "type": "text",
+            "required": False,
+        },
     ],
 }
 
@@ -117,50 +495,69 @@ def upload(
     """
     input_files = get_input_files(pipe_result, input_files or [])
 
-    # Connection details from environment variables.
-    timesketch_server_url = os.environ.get("TIMESKETCH_SERVER_URL")
-    timesketch_server_public_url = os.environ.get("TIMESKETCH_SERVER_PUBLIC_URL")
-    timesketch_username = os.environ.get("TIMESKETCH_USERNAME")
-    timesketch_password = os.environ.get("TIMESKETCH_PASSWORD")
+    # Skip empty files up front instead of having the server reject them. A missing
+    # file raises FileNotFoundError and fails the task.
+    non_empty_input_files = []
+    for input_file in input_files:
+        if os.stat(input_file.get("path")).st_size > 0:
+            non_empty_input_files.append(input_file)
+        else:
+            logger.warning("Skipping empty file: %s", input_file.get("path"))
+    input_files = non_empty_input_files
 
-    # User supplied config.
-    sketch_id = task_config.get("sketch_id")
-    sketch_name = task_config.get("sketch_name")
+    # Fail before touching Timesketch if a file can't be imported.
+    for input_file in input_files:
+        if _file_type(input_file.get("path")) not in SUPPORTED_FILE_TYPES:
+            raise ValueError(
+                f"Unsupported file type for Timesketch import: "
+                f"{input_file.get('path')} (expected .csv, .jsonl or .plaso)"
+            )
 
-    # Create a Timesketch API client.
-    timesketch_api_client = timesketch_client.TimesketchApi(
-        host_uri=timesketch_server_url,
-        username=timesketch_username,
-        password=timesketch_password,
-    )
+    # Nothing to import, so don't touch Timesketch at all.
+    if not input_files:
+        return create_task_result(
+            output_files=[],
+            workflow_id=workflow_id,
+            command="Timesketch Importer Client",
+        )
 
-    # Get or create sketch using a distributed lock.
-    sketch = get_or_create_sketch(
-        timesketch_api_client,
-        redis_client,
-        sketch_id=sketch_id,
-        workflow_id=workflow_id,
-    )
-
-    if not sketch:
-        raise Exception(f"Failed to create or retrieve sketch '{sketch_name}'")
+    # Claim the upload with an in-progress marker, which is kept alive while the
+    # import runs. A redelivered copy of this task, e.g. after the broker visibility
+    # timeout, finds the marker or the result of the completed upload instead of
+    # importing the timelines again.
+    upload_result_key = _upload_result_key(workflow_id, input_files, task_config)
+    upload_token = f"{UPLOAD_IN_PROGRESS_PREFIX}{uuid.uuid4().hex}"
+    if not redis_client.set(
+        upload_result_key, upload_token, nx=True, ex=UPLOAD_CLAIM_TTL
+    ):
+        previous_result = redis_client.get(upload_result_key)
+        if previous_result and not previous_result.startswith(
+            UPLOAD_IN_PROGRESS_PREFIX.encode()
+        ):
+            return previous_result.decode()
+        # Another copy of this task is still importing, check back later.
+        raise self.retry(
+            countdown=UPLOAD_IN_PROGRESS_RETRY_DELAY,
+            max_retries=UPLOAD_IN_PROGRESS_MAX_RETRIES,
+        )
 
-    # Make the sketch public.
-    # TODO: Make this user configurable.
-    sketch.add_to_acl(group_list=["all"])
+    stop_heartbeat = threading.Event()
+    heartbeat = threading.Thread(
+        target=_keep_claim_alive,
+        args=(redis_client, upload_result_key, upload_token, stop_heartbeat),
+        daemon=True,
+    )
+    heartbeat.start()
+    try:
+        result = _import_to_timesketch(input_files, workflow_id, task_config)
+    except BaseException:
+        # Release the claim so that a retry of this task starts over.
+        _delete_if_value(redis_client, upload_result_key, upload_token)
+        raise
+    finally:
+        stop_heartbeat.set()
+        heartbeat.join()
 
-    # Import each input file to it's own index.
-    for input_file in input_files:
-        input_file_path = input_file.get("path")
-        timeline_name = input_file.get("display_name")
-        with importer.ImportStreamer() as streamer:
-            streamer.set_sketch(sketch)
-            streamer.set_timeline_name(timeline_name)
-            streamer.add_file(input_file_path)
+    redis_client.set(upload_result_key, result, ex=UPLOAD_RESULT_TTL)
 
-    return create_task_result(
-        output_files=[],
-        workflow_id=workflow_id,
-        command="Timesketch Importer Client",
-        meta={"sketch": f"{timesketch_server_public_url}/sketch/{sketch.id}"},
-    )
+    return result
@@ -0,0 +1,22 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+# The worker reads its configuration at import time.
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+os.environ.setdefault("TIMESKETCH_SERVER_URL", "http://timesketch.test")
+os.environ.setdefault("TIMESKETCH_SERVER_PUBLIC_URL", "http://timesketch.test")
+os.environ.setdefault("TIMESKETCH_USERNAME", "openrelik")
+os.environ.setdefault("TIMESKETCH_PASSWORD", "password")
@@ -0,0 +1,424 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import requests
+from celery.exceptions import Retry
+
+from src import tasks
+
+
+class FakeRedis:
+    """Minimal in-memory stand-in for the Redis client."""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        if not isinstance(value, bytes):
+            value = str(value).encode()
+        self.data[key] = value
+        self.ttls[key] = ex
+        return True
+
+    def delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+    def eval(self, script, numkeys, key, value, *args):
+        # The worker only uses eval to delete or expire a key holding a given value.
+        if self.data.get(key) != str(value).encode():
+            return 0
+        if script == tasks._EXPIRE_IF_VALUE_SCRIPT:
+            self.ttls[key] = int(args[0])
+            return 1
+        return self.delete(key)
+
+
+class TestGetOrCreateWorkflowSketch(unittest.TestCase):
+    """Tests for resolving the default workflow sketch."""
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.api = mock.Mock()
+        self.api.list_sketches.return_value = []
+        self.api.get_sketch.side_effect = lambda sketch_id: mock.Mock(id=sketch_id)
+        self.api.create_sketch.return_value = mock.Mock(id=42)
+        self.cache_key = tasks._sketch_cache_key("wf")
+        self.lock_key = tasks._sketch_lock_key("wf")
+
+    def get_or_create_sketch(self):
+        return tasks.get_or_create_sketch(self.api, self.redis, workflow_id="wf")
+
+    def test_winner_creates_and_caches_sketch(self):
+        sketch = self.get_or_create_sketch()
+        self.assertEqual(sketch.id, 42)
+        self.api.create_sketch.assert_called_once_with("openrelik-workflow-wf")
+        self.assertEqual(self.redis.get(self.cache_key), b"42")
+
+    def test_winner_reuses_existing_sketch(self):
+        existing = mock.Mock(id=7)
+        existing.name = "openrelik-workflow-wf"
+        self.api.list_sketches.return_value = [existing]
+        self.assertIs(self.get_or_create_sketch(), existing)
+        self.api.create_sketch.assert_not_called()
+        self.assertEqual(self.redis.get(self.cache_key), b"7")
+
+    def test_winner_scans_all_sketches(self):
+        sketches = [mock.Mock(id=i) for i in range(2001)]
+        for i, sketch in enumerate(sketches):
+            sketch.name = f"sketch-{i}"
+        sketches[-1].name = "openrelik-workflow-wf"
+        self.api.list_sketches.return_value = iter(sketches)
+        self.assertIs(self.get_or_create_sketch(), sketches[-1])
+        self.api.create_sketch.assert_not_called()
+
+    def test_cache_hit_skips_lookup(self):
+        self.redis.set(self.cache_key, 7)
+        self.assertEqual(self.get_or_create_sketch().id, 7)
+        self.api.list_sketches.assert_not_called()
+        self.api.create_sketch.assert_not_called()
+
+    def test_stale_cache_entry_is_replaced(self):
+        self.redis.set(self.cache_key, 7)
+        stale_sketch = mock.Mock(id=7)
+        stale_sketch.lazyload_data.side_effect = RuntimeError("Not found")
+        self.api.get_sketch.side_effect = [stale_sketch]
+        self.assertEqual(self.get_or_create_sketch().id, 42)
+        self.assertEqual(self.redis.get(self.cache_key), b"42")
+
+    def test_loser_waits_for_winner(self):
+        self.redis.set(self.lock_key, "other-worker")
+
+        def _winner_finishes(seconds):
+            self.redis.set(self.cache_key, 7)
+
+        with mock.patch.object(tasks.time, "sleep", side_effect=_winner_finishes):
+            self.assertEqual(self.get_or_create_sketch().id, 7)
+        self.api.create_sketch.assert_not_called()
+
+    def test_loser_times_out(self):
+        self.redis.set(self.lock_key, "other-worker")
+        with mock.patch.object(tasks, "SKETCH_WAIT_TIMEOUT", 0):
+            with self.assertRaisesRegex(TimeoutError, "openrelik-workflow-wf"):
+                self.get_or_create_sketch()
+        self.api.create_sketch.assert_not_called()
+
+    def test_failure_releases_lock(self):
+        self.api.create_sketch.side_effect = RuntimeError("Unable to create")
+        with self.assertRaises(RuntimeError):
+            self.get_or_create_sketch()
+        self.assertIsNone(self.redis.get(self.lock_key))
+        self.assertIsNone(self.redis.get(self.cache_key))
+
+    def test_failure_keeps_lock_claimed_by_another_worker(self):
+        def _lock_expires_and_is_claimed(sketch_name):
+            self.redis.set(self.lock_key, "other-worker")
+            raise RuntimeError("Unable to create")
+
+        self.api.create_sketch.side_effect = _lock_expires_and_is_claimed
+        with self.assertRaises(RuntimeError):
+            self.get_or_create_sketch()
+        self.assertEqual(self.redis.get(self.lock_key), b"other-worker")
+
+
+class UploadTestCase(unittest.TestCase):
+    """Base class for tests running the upload task against fakes."""
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.sketch = mock.Mock(id=1)
+        self.imported = []
+        self.streamer_count = 0
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+        patches = [
+            mock.patch.object(tasks, "redis_client", self.redis),
+            mock.patch.object(tasks, "_get_ts_client"),
+            mock.patch.object(tasks, "get_or_create_sketch", return_value=self.sketch),
+            mock.patch(
+                "timesketch_import_client.importer.ImportStreamer",
+                side_effect=self._make_streamer,
+            ),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _make_streamer(self):
+        """Returns a fake ImportStreamer recording (timeline, path) imports."""
+        self.streamer_count += 1
+        streamer = mock.MagicMock()
+        streamer.__enter__.return_value = streamer
+        streamer.set_timeline_name.side_effect = lambda name: setattr(
+            streamer, "timeline_name", name
+        )
+        streamer.add_file.side_effect = lambda path: self._import(
+            streamer.timeline_name, path
+        )
+        return streamer
+
+    def _import(self, timeline_name, path):
+        self.imported.append((timeline_name, os.path.basename(path)))
+
+    def make_input_file(self, name, content="data", display_name=None):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "w") as fh:
+            fh.write(content)
+        return {"path": path, "display_name": display_name or name}
+
+    def run_upload(self, input_files, task_config=None, workflow_id="wf"):
+        return tasks.upload.run(
+            input_files=input_files,
+            workflow_id=workflow_id,
+            task_config=task_config or {},
+        )
+
+
+class TestGetTsClient(unittest.TestCase):
+    """Tests for the shared Timesketch API client."""
+
+    def setUp(self):
+        tasks._ts_client = None
+        self.addCleanup(setattr, tasks, "_ts_client", None)
+        patcher = mock.patch("timesketch_api_client.client.TimesketchApi")
+        self.mock_api = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_api.side_effect = lambda **kwargs: mock.Mock(
+            session=requests.Session()
+        )
+
+    def test_client_is_reused(self):
+        self.assertIs(tasks._get_ts_client(), tasks._get_ts_client())
+        self.assertEqual(self.mock_api.call_count, 1)
+
+    def test_client_is_rebuilt_after_max_age(self):
+        client = tasks._get_ts_client()
+        with mock.patch.object(tasks, "TIMESKETCH_CLIENT_MAX_AGE", -1):
+            self.assertIsNot(tasks._get_ts_client(), client)
+
+    def test_client_is_rebuilt_after_auth_error(self):
+        client = tasks._get_ts_client()
+        response = requests.Response()
+        response.status_code = 403
+        for hook in client.session.hooks["response"]:
+            hook(response)
+        self.assertIsNot(tasks._get_ts_client(), client)
+        self.assertEqual(self.mock_api.call_count, 2)
+
+    def test_client_is_kept_after_success(self):
+        client = tasks._get_ts_client()
+        response = requests.Response()
+        response.status_code = 200
+        for hook in client.session.hooks["response"]:
+            hook(response)
+        self.assertIs(tasks._get_ts_client(), client)
+
+
+class TestUploadTimelines(UploadTestCase):
+    """Tests for how input files are mapped to timelines."""
+
+    def test_files_get_own_timeline_by_default(self):
+        input_files = [
+            self.make_input_file("a.plaso", display_name="disk.plaso"),
+            self.make_input_file("b.plaso", display_name="disk.plaso"),
+        ]
+        self.run_upload(input_files)
+        self.assertCountEqual(
+            self.imported, [("disk.plaso", "a.plaso"), ("disk.plaso", "b.plaso")]
+        )
+        self.assertEqual(self.streamer_count, 2)
+
+    def test_unsupported_file_type_fails_before_timesketch(self):
+        input_files = [
+            self.make_input_file("a.csv"),
+            self.make_input_file("notes"),
+        ]
+        with self.assertRaisesRegex(ValueError, "Unsupported file type"):
+            self.run_upload(input_files, task_config={"timeline_name": "all"})
+        tasks.get_or_create_sketch.assert_not_called()
+        self.assertEqual(self.imported, [])
+
+    def test_timeline_name_gives_one_timeline_per_file_type(self):
+        input_files = [
+            self.make_input_file("a.csv"),
+            self.make_input_file("b.jsonl"),
+            self.make_input_file("c.csv"),
+        ]
+        self.run_upload(input_files, task_config={"timeline_name": "all"})
+        self.assertCountEqual(
+            self.imported, [("all", "a.csv"), ("all", "b.jsonl"), ("all", "c.csv")]
+        )
+        self.assertEqual(self.streamer_count, 2)
+
+
+class TestUploadInputFiles(UploadTestCase):
+    """Tests for input file validation in upload."""
+
+    def test_empty_files_are_skipped(self):
+        input_files = [
+            self.make_input_file("a.csv"),
+            self.make_input_file("empty.csv", content=""),
+        ]
+        self.run_upload(input_files)
+        self.assertEqual(self.imported, [("a.csv", "a.csv")])
+
+    def test_only_empty_files_skip_timesketch(self):
+        self.run_upload([self.make_input_file("empty.csv", content="")])
+        tasks._get_ts_client.assert_not_called()
+        tasks.get_or_create_sketch.assert_not_called()
+        self.assertEqual(self.redis.data, {})
+
+    def test_missing_file_fails(self):
+        with self.assertRaises(FileNotFoundError):
+            self.run_upload([{"path": "/nonexistent.csv", "display_name": "x"}])
+
+
+class TestUploadSketch(UploadTestCase):
+    """Tests for how upload selects the sketch."""
+
+    def test_sketch_config_is_passed_on(self):
+        self.run_upload(
+            [self.make_input_file("a.csv")], task_config={"sketch_name": "case"}
+        )
+        tasks.get_or_create_sketch.assert_called_once_with(
+            tasks._get_ts_client.return_value,
+            self.redis,
+            sketch_id=None,
+            sketch_name="case",
+            workflow_id="wf",
+        )
+
+
+class TestUploadConcurrency(UploadTestCase):
+    """Tests for the concurrent imports in upload."""
+
+    def test_failed_import_cancels_queued_imports(self):
+        input_files = [
+            self.make_input_file("a.csv"),
+            self.make_input_file("b.csv"),
+        ]
+
+        def _fail(timeline_name, path):
+            raise RuntimeError("Import failed")
+
+        self._import = mock.Mock(side_effect=_fail)
+        with mock.patch.object(tasks, "IMPORT_CONCURRENCY", 1):
+            with self.assertRaisesRegex(RuntimeError, "Import failed"):
+                self.run_upload(input_files)
+        self.assertEqual(self._import.call_count, 1)
+
+
+class TestUploadResultKey(unittest.TestCase):
+    """Tests for the Redis key identifying an upload."""
+
+    def test_key_ignores_input_file_order(self):
+        files = [{"path": "/a.csv"}, {"path": "/b.csv"}]
+        self.assertEqual(
+            tasks._upload_result_key("wf", files, {}),
+            tasks._upload_result_key("wf", files[::-1], {}),
+        )
+
+    def test_key_depends_on_workflow_files_and_config(self):
+        key = tasks._upload_result_key("wf", [{"path": "/a.csv"}], {})
+        self.assertTrue(key.startswith("openrelik:upload:wf:"))
+        self.assertNotEqual(
+            key, tasks._upload_result_key("wf2", [{"path": "/a.csv"}], {})
+        )
+        self.assertNotEqual(
+            key, tasks._upload_result_key("wf", [{"path": "/b.csv"}], {})
+        )
+        self.assertNotEqual(
+            key,
+            tasks._upload_result_key("wf", [{"path": "/a.csv"}], {"sketch_id": "1"}),
+        )
+
+
+class TestUploadIdempotency(UploadTestCase):
+    """Tests for skipping uploads that already ran."""
+
+    def setUp(self):
+        super().setUp()
+        self.input_files = [self.make_input_file("a.csv")]
+        self.key = tasks._upload_result_key("wf", self.input_files, {})
+
+    def test_result_replaces_in_progress_marker(self):
+        result = self.run_upload(self.input_files)
+        self.assertEqual(self.redis.get(self.key), result.encode())
+
+    def test_completed_upload_returns_cached_result(self):
+        self.redis.set(self.key, "cached-result")
+        self.assertEqual(self.run_upload(self.input_files), "cached-result")
+        tasks.get_or_create_sketch.assert_not_called()
+        self.assertEqual(self.imported, [])
+
+    def test_upload_in_progress_is_retried(self):
+        self.redis.set(self.key, tasks.UPLOAD_IN_PROGRESS_PREFIX + "other-worker")
+        with self.assertRaises(Retry):
+            self.run_upload(self.input_files)
+        tasks.get_or_create_sketch.assert_not_called()
+        self.assertEqual(self.imported, [])
+
+    def test_redelivered_copy_during_import_is_retried(self):
+        redelivered = []
+
+        def _redeliver(timeline_name, path):
+            with self.assertRaises(Retry):
+                self.run_upload(self.input_files)
+            redelivered.append(path)
+
+        self._import = _redeliver
+        self.run_upload(self.input_files)
+        self.assertEqual(len(redelivered), 1)
+
+    def test_claim_is_kept_alive_during_import(self):
+        refreshed_ttls = []
+
+        def _slow_import(timeline_name, path):
+            self.redis.ttls[self.key] = None
+            time.sleep(0.1)
+            refreshed_ttls.append(self.redis.ttls[self.key])
+
+        self._import = _slow_import
+        with mock.patch.object(tasks, "UPLOAD_CLAIM_REFRESH_INTERVAL", 0.01):
+            self.run_upload(self.input_files)
+        self.assertEqual(refreshed_ttls, [tasks.UPLOAD_CLAIM_TTL])
+
+    def test_claim_refresh_ignores_other_claims(self):
+        self.redis.set(self.key, "other-worker", ex=10)
+        tasks._expire_if_value(self.redis, self.key, "mine", 180)
+        self.assertEqual(self.redis.ttls[self.key], 10)
+        tasks._expire_if_value(self.redis, self.key, "other-worker", 180)
+        self.assertEqual(self.redis.ttls[self.key], 180)
+
+    def test_failed_upload_releases_claim(self):
+        tasks.get_or_create_sketch.side_effect = RuntimeError("Unavailable")
+        with self.assertRaises(RuntimeError):
+            self.run_upload(self.input_files)
+        self.assertIsNone(self.redis.get(self.key))
+
+
+if __name__ == "__main__":
+    unittest.main()